@@ -13,46 +13,68 @@ Usage :
   python ask.py photo.jpg "Q1 ?" "Q2 ?" "Q3 ?"
   python ask.py photo.jpg --model chandra --questions-file questions.txt
   python ask.py photo.jpg --interactive
+  python ask.py file:///workspace/scans/photo.jpg --interactive
+
+L'image peut être un chemin local (envoyé en base64) ou une URL http(s)://
+ou file:// (fichier sur le Network Volume du pod, limité à /workspace/scans
+par --allowed-local-media-path dans le startup vLLM) : seule l'URL est alors
+transmise, à chaque tour.
 """
 
 import argparse
-import base64
+import importlib.util
+import io
 import json
-import os
 import sys
 from pathlib import Path
 
+import httpx
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from runpod_util import (
+    dumps as _dumps, image_to_base64, loads as _loads, prefix_hash, resolve_pod_id, strip_code_fences,
+)
+
 
 # ── Backends ─────────────────────────────────────────────────
 
 BACKENDS: dict[str, dict[str, str]] = {
-    "qwen3":   {"env_var": "QWEN3VL_POD_ID",  "model_name": "qwen3-vl"},
-    "chandra": {"env_var": "CHANDRA_POD_ID",   "model_name": "chandra"},
+    "qwen3":   {"env_var": "QWEN3VL_POD_ID",  "pod_name": "fuzzion-qwen3vl", "model_name": "qwen3-vl"},
+    "chandra": {"env_var": "CHANDRA_POD_ID",   "pod_name": "fuzzion-chandra", "model_name": "chandra"},
 }
 
 
-# ── Image helper ─────────────────────────────────────────────
+# ── Image content ────────────────────────────────────────────
 
-def image_to_base64(image_path: str) -> tuple[str, str]:
-    path = Path(image_path)
-    mime_map = {
-        ".jpg": "image/jpeg", ".jpeg": "image/jpeg",
-        ".png": "image/png",  ".webp": "image/webp",
-        ".bmp": "image/bmp",  ".tiff": "image/tiff", ".tif": "image/tiff",
-    }
-    mime = mime_map.get(path.suffix.lower(), "image/jpeg")
-    data = base64.b64encode(path.read_bytes()).decode("utf-8")
-    return data, mime
+REMOTE_IMAGE_SCHEMES = ("http://", "https://", "file://")
 
 
-def image_content_block(img_b64: str, mime: str) -> dict:
-    return {
-        "type": "image_url",
-        "image_url": {"url": f"data:{mime};base64,{img_b64}"},
-    }
+def image_content_block(image_url: str) -> dict:
+    return {"type": "image_url", "image_url": {"url": image_url}}
+
+
+def user_content(text: str, image_url: str) -> list[dict]:
+    """Canonical user turn: text first, image last.
+
+    vLLM's prefix cache cannot reuse any block that follows the image tokens,
+    so the image must never precede text that could otherwise be shared.
+    """
+    return [{"type": "text", "text": text}, image_content_block(image_url)]
+
+
+# ── HTTP client ──────────────────────────────────────────────
+
+def make_http_client() -> httpx.Client:
+    """Keep-alive HTTP client so interactive turns reuse the same connection.
+
+    Uses HTTP/2 when the h2 package is installed, HTTP/1.1 otherwise.
+    """
+    return httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=httpx.Timeout(connect=10.0, read=600.0, write=60.0, pool=10.0),
+    )
 
 
 # ── Batch mode ───────────────────────────────────────────────
@@ -62,6 +84,8 @@ BATCH_SYSTEM = (
     "Answer each question using only information visible in the provided image. "
     "Be concise and exact — return only the extracted value, no explanation."
 )
+SYSTEM_MESSAGE = {"role": "system", "content": BATCH_SYSTEM}
+
 
 def build_batch_prompt(questions: list[str]) -> str:
     lines = [
@@ -77,55 +101,78 @@ def build_batch_prompt(questions: list[str]) -> str:
     return "\n".join(lines)
 
 
-def ask_batch(client: OpenAI, model: str, img_b64: str, mime: str,
+def ask_batch(client: OpenAI, model: str, image_url: str,
               questions: list[str]) -> dict[str, str | None]:
     prompt = build_batch_prompt(questions)
     stream = client.chat.completions.create(
         model=model,
         messages=[
-            {"role": "system", "content": BATCH_SYSTEM},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    image_content_block(img_b64, mime),
-                ],
-            },
+            SYSTEM_MESSAGE,
+            {"role": "user", "content": user_content(prompt, image_url)},
         ],
         temperature=0.0,
         max_tokens=1024,
         extra_body={"repetition_penalty": 1.15},
         stream=True,
     )
-    parts: list[str] = []
+    buf = io.StringIO()
     for chunk in stream:
         if chunk.choices and chunk.choices[0].delta.content:
-            parts.append(chunk.choices[0].delta.content)
-    raw = "".join(parts).strip()
-    # Strip markdown fences if present
-    if raw.startswith("```"):
-        lines = raw.split("\n")[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        raw = "\n".join(lines)
+            buf.write(chunk.choices[0].delta.content)
+    raw = strip_code_fences(buf.getvalue().strip())
     try:
-        return json.loads(raw)
+        return _loads(raw)
     except json.JSONDecodeError:
         return {"error": raw}
 
 
 # ── Interactive mode ─────────────────────────────────────────
 
-def run_interactive(client: OpenAI, model: str, img_b64: str, mime: str,
-                    image_path: str) -> None:
+CONTEXT_MODES = ("full", "sliding", "minimal")
+
+# History budget in sliding mode, estimated at ~4 characters per token.
+# The system prompt and the first (image) turn are never dropped.
+MAX_CTX_TOKENS = 4096
+
+
+def _estimate_tokens(message: dict) -> int:
+    content = message["content"]
+    if isinstance(content, list):
+        return sum(len(part.get("text", "")) for part in content) // 4
+    return len(content) // 4
+
+
+def trim_history(messages: list[dict], max_tokens: int = MAX_CTX_TOKENS) -> None:
+    """Drop the oldest Q/A pairs after the first exchange until the rest fits.
+
+    Expects [system, user+image, assistant, ..., user] and always keeps the
+    first exchange and the pending question.
+    """
+    while len(messages) > 4 and sum(_estimate_tokens(m) for m in messages[3:]) > max_tokens:
+        del messages[3:5]
+
+
+def run_interactive(client: OpenAI, model: str, image_url: str,
+                    image_path: str, context_mode: str = "full") -> None:
     """Multi-turn conversation. The image is sent once in the first message;
     subsequent turns reuse the server-side KV cache (requires
-    --enable-prefix-caching in vLLM)."""
+    --enable-prefix-caching in vLLM).
+
+    context_mode controls what is resent on each turn:
+      - full    : the whole transcript (default)
+      - sliding : the transcript, oldest exchanges dropped past MAX_CTX_TOKENS
+      - minimal : only the first exchange (which carries the image) and the
+                  current question, no other prior turns
+
+    The API is stateless, so every request still uploads the first message
+    and its image; what the modes save is prompt tokens, the unchanged
+    [system, first exchange] prefix being served from vLLM's prefix cache.
+    """
     print(f"Image : {image_path}")
     print("Mode interactif — posez vos questions (Ctrl+D ou 'quit' pour quitter)\n")
 
     messages: list[dict] = [
-        {"role": "system", "content": BATCH_SYSTEM},
+        SYSTEM_MESSAGE,
     ]
     first_turn = True
 
@@ -139,15 +186,14 @@ def run_interactive(client: OpenAI, model: str, img_b64: str, mime: str,
 
         if first_turn:
             # Include the image only on the first turn
-            content = [
-                {"type": "text", "text": question},
-                image_content_block(img_b64, mime),
-            ]
+            content = user_content(question, image_url)
             first_turn = False
         else:
             content = question  # type: ignore[assignment]
 
         messages.append({"role": "user", "content": content})
+        if context_mode == "sliding":
+            trim_history(messages)
 
         stream = client.chat.completions.create(
             model=model,
@@ -157,12 +203,17 @@ def run_interactive(client: OpenAI, model: str, img_b64: str, mime: str,
             extra_body={"repetition_penalty": 1.15},
             stream=True,
         )
-        parts: list[str] = []
+        buf = io.StringIO()
         for chunk in stream:
             if chunk.choices and chunk.choices[0].delta.content:
-                parts.append(chunk.choices[0].delta.content)
-        answer = "".join(parts)
-        messages.append({"role": "assistant", "content": answer})
+                buf.write(chunk.choices[0].delta.content)
+        answer = buf.getvalue()
+        if context_mode == "minimal" and len(messages) > 3:
+            # Keep [system, first question + image, first answer] only: that
+            # prefix is identical on every turn, so its image tokens stay cached
+            del messages[3:]
+        else:
+            messages.append({"role": "assistant", "content": answer})
         print(f"Réponse : {answer}\n")
 
 
@@ -174,7 +225,7 @@ def main() -> None:
     parser = argparse.ArgumentParser(
         description="Interrogation ciblée d'une image via vLLM sur RunPod"
     )
-    parser.add_argument("image", help="Chemin vers l'image (JPEG, PNG…)")
+    parser.add_argument("image", help="Chemin vers l'image (JPEG, PNG…) ou URL http(s):// / file://")
     parser.add_argument(
         "questions", nargs="*",
         help="Questions à poser (une ou plusieurs, entre guillemets)",
@@ -191,35 +242,55 @@ def main() -> None:
         "--interactive", "-i", action="store_true",
         help="Mode interactif multi-tour (nécessite --enable-prefix-caching sur vLLM)",
     )
+    parser.add_argument(
+        "--context-mode", choices=CONTEXT_MODES, default="full",
+        help="Historique renvoyé à chaque tour en mode interactif : full (tout, "
+             "défaut), sliding (anciens échanges supprimés au-delà d'un budget), "
+             "minimal (premier échange avec l'image + question courante)",
+    )
     parser.add_argument(
         "--output", "-o", default=None,
         help="Fichier de sortie JSON (batch uniquement, défaut : stdout)",
     )
+    parser.add_argument(
+        "--max-edge", type=int, default=1920,
+        help="Taille max (px) du plus grand côté de l'image, réduite avant envoi "
+             "(défaut : 1920, 0 = pas de réduction)",
+    )
     args = parser.parse_args()
 
+    is_remote = args.image.startswith(REMOTE_IMAGE_SCHEMES)
     image_path = Path(args.image)
-    if not image_path.exists():
+    if not is_remote and not image_path.exists():
         print(f"Erreur : fichier introuvable : {image_path}", file=sys.stderr)
         sys.exit(1)
 
     backend = BACKENDS[args.model]
-    pod_id = os.environ.get(backend["env_var"])
+    pod_id = resolve_pod_id(backend["env_var"], backend["pod_name"])
     if not pod_id:
-        print(f"Erreur : {backend['env_var']} manquant dans .env", file=sys.stderr)
+        print(f"Erreur : {backend['env_var']} manquant dans .env "
+              f"et aucun pod {backend['pod_name']} actif", file=sys.stderr)
         sys.exit(1)
 
     model_name = backend["model_name"]
     client = OpenAI(
         base_url=f"https://{pod_id}-8000.proxy.runpod.net/v1",
         api_key="not-needed",
+        http_client=make_http_client(),
     )
     print(f"Backend : {args.model} ({model_name})", file=sys.stderr)
+    print(f"Préfixe système : {prefix_hash(SYSTEM_MESSAGE)}", file=sys.stderr)
 
-    print(f"Chargement de l'image {image_path.name}…", file=sys.stderr)
-    img_b64, mime = image_to_base64(str(image_path))
+    if is_remote:
+        # The server fetches the image itself: only the short URL is sent
+        image_url = args.image
+    else:
+        print(f"Chargement de l'image {image_path.name}…", file=sys.stderr)
+        img_b64, mime = image_to_base64(str(image_path), args.max_edge)
+        image_url = f"data:{mime};base64,{img_b64}"
 
     if args.interactive:
-        run_interactive(client, model_name, img_b64, mime, str(image_path))
+        run_interactive(client, model_name, image_url, args.image, args.context_mode)
         return
 
     # Collect questions
@@ -229,10 +300,8 @@ def main() -> None:
         if not qs_path.exists():
             print(f"Erreur : fichier introuvable : {qs_path}", file=sys.stderr)
             sys.exit(1)
-        for line in qs_path.read_text(encoding="utf-8").splitlines():
-            line = line.strip()
-            if line and not line.startswith("#"):
-                questions.append(line)
+        with qs_path.open(encoding="utf-8") as fh:
+            questions.extend(q for line in fh if (q := line.strip()) and not q.startswith("#"))
 
     if not questions:
         print("Erreur : aucune question fournie. "
@@ -241,14 +310,14 @@ def main() -> None:
         sys.exit(1)
 
     print(f"Envoi de {len(questions)} question(s)…", file=sys.stderr)
-    results = ask_batch(client, model_name, img_b64, mime, questions)
+    results = ask_batch(client, model_name, image_url, questions)
 
     # Format output: align questions with answers
     output_data = {
         str(i): {"question": q, "answer": results.get(str(i))}
         for i, q in enumerate(questions, 1)
     }
-    output = json.dumps(output_data, indent=2, ensure_ascii=False)
+    output = _dumps(output_data)
 
     if args.output:
         Path(args.output).write_text(output, encoding="utf-8")
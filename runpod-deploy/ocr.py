@@ -9,25 +9,36 @@ Usage :
   python ocr.py photo.jpg
   python ocr.py photo.jpg --model chandra
   python ocr.py document.pdf --pages 1-3 --format json -o result.json
+  python ocr.py document.pdf --render-format png --render-scale 2
 """
 
 import argparse
+import asyncio
 import base64
+import importlib.util
+import io
 import json
 import os
 import re
 import sys
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIError, AsyncOpenAI
+
+from runpod_util import (
+    dumps as _dumps, image_to_base64, loads as _loads, parse_page_range, prefix_hash, resolve_pod_id,
+    strip_code_fences,
+)
 
 
 # ── Backends ─────────────────────────────────────────────────
 
 BACKENDS: dict[str, dict] = {
-    "qwen3":   {"env_var": "QWEN3VL_POD_ID",  "model_name": "qwen3-vl", "repetition_penalty": 1.15, "max_tokens": 8192},
-    "chandra": {"env_var": "CHANDRA_POD_ID",   "model_name": "chandra",  "repetition_penalty": 1.15, "max_tokens": 8192},
+    "qwen3":   {"env_var": "QWEN3VL_POD_ID",  "pod_name": "fuzzion-qwen3vl", "model_name": "qwen3-vl", "repetition_penalty": 1.15, "max_tokens": 8192},
+    "chandra": {"env_var": "CHANDRA_POD_ID",   "pod_name": "fuzzion-chandra", "model_name": "chandra",  "repetition_penalty": 1.15, "max_tokens": 8192},
 }
 
 
@@ -41,60 +52,50 @@ def get_page_count(pdf_path: str) -> int:
     return count
 
 
-def pdf_page_to_base64png(pdf_path: str, page_index: int) -> str:
-    """Render a PDF page to a base64 PNG string (0-indexed)."""
-    import pypdfium2 as pdfium
-    doc = pdfium.PdfDocument(pdf_path)
+RENDER_MIME = {"jpeg": "image/jpeg", "png": "image/png"}
+
+
+def render_page(doc, page_index: int,
+                render_format: str = "jpeg", scale: float = 1.5) -> str:
+    """Render a page of an open PdfDocument to a base64 JPEG or PNG string (0-indexed)."""
     page = doc[page_index]
-    # Render at 2x for good quality (default is 72 dpi → 144 dpi)
-    bitmap = page.render(scale=2)
+    # Default is 72 dpi; scale 1.5 → 108 dpi, enough since the VLMs resize anyway.
+    # rev_byteorder gives RGB directly, so PIL wraps the pdfium buffer as-is.
+    bitmap = page.render(scale=scale, rev_byteorder=True)
     pil_image = bitmap.to_pil()
-    doc.close()
 
-    import io
     buf = io.BytesIO()
-    pil_image.save(buf, format="PNG")
+    if render_format == "png":
+        pil_image.save(buf, format="PNG")
+    else:
+        # JPEG is 5-10x smaller than PNG for scanned pages, no visible OCR loss
+        if pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        pil_image.save(buf, format="JPEG", quality=85, optimize=True)
+    bitmap.close()
+    page.close()
     return base64.b64encode(buf.getvalue()).decode("utf-8")
 
 
-# ── Image helper ─────────────────────────────────────────────
+# Documents opened by this render worker, kept for the life of the process
+_worker_docs: dict = {}
 
-def image_to_base64(image_path: str) -> tuple[str, str]:
-    """Read an image file and return (base64_data, mime_type)."""
-    path = Path(image_path)
-    suffix = path.suffix.lower()
-    mime_map = {
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".webp": "image/webp",
-        ".gif": "image/gif",
-        ".bmp": "image/bmp",
-        ".tiff": "image/tiff",
-        ".tif": "image/tiff",
-    }
-    mime = mime_map.get(suffix, "image/jpeg")
-    data = base64.b64encode(path.read_bytes()).decode("utf-8")
-    return data, mime
 
+def _render_page(pdf_path: str, page_index: int,
+                 render_format: str, scale: float) -> tuple[str, str]:
+    """Process-pool worker: render one page, return (base64_data, mime_type).
 
-# ── Page range parsing ───────────────────────────────────────
+    pdfium handles cannot be pickled, so each worker opens the document once
+    and reuses it for every page it renders.
+    """
+    doc = _worker_docs.get(pdf_path)
+    if doc is None:
+        import pypdfium2 as pdfium
+        doc = _worker_docs[pdf_path] = pdfium.PdfDocument(pdf_path)
+    return render_page(doc, page_index, render_format, scale), RENDER_MIME[render_format]
 
-def parse_page_range(spec: str, total: int) -> list[int]:
-    """Parse '3', '1-5', or '2,4,7-9' into a sorted list of 1-based page numbers."""
-    pages = set()
-    for part in spec.split(","):
-        part = part.strip()
-        if "-" in part:
-            start, end = part.split("-", 1)
-            start, end = int(start), int(end)
-            pages.update(range(start, min(end, total) + 1))
-        else:
-            p = int(part)
-            if 1 <= p <= total:
-                pages.add(p)
-    return sorted(pages)
 
+# ── Page range parsing ───────────────────────────────────────
 
 # ── Fill-zone normalization ──────────────────────────────────
 
@@ -106,6 +107,19 @@ def normalize_fill_zones(text: str) -> str:
     return _FILL_RE.sub('___', text)
 
 
+# Text-mode cleanup in a single pass: any run of HTML tags and spaces that
+# contains a tag or 2+ spaces becomes one space, fill zones become "___".
+# Equivalent to stripping tags, then collapsing spaces, then normalize_fill_zones.
+_TEXT_CLEANUP_RE = re.compile(r' *<[^>]+>(?: |<[^>]+>)*| {2,}|([.\-_])\1{3,}')
+
+def _text_cleanup_sub(m: re.Match) -> str:
+    return '___' if m.group(1) else ' '
+
+def clean_text_output(raw: str) -> str:
+    """Safety net for text mode: strip markup the model returned anyway."""
+    return _TEXT_CLEANUP_RE.sub(_text_cleanup_sub, raw).strip()
+
+
 # ── Prompts ──────────────────────────────────────────────────
 
 _FILL_ZONE_RULE = (
@@ -118,8 +132,8 @@ _FILL_ZONE_RULE = (
 
 PROMPT_TEXT_ONLY = (
     "Extract all the alphanumeric text from this image. Return plain text only, "
-    "preserving the reading order."
-    "Ignore dotted lines. Ignore ".....". Only transcribe actual alphanumeric text."
+    "preserving the reading order. "
+    "Ignore dotted lines. Ignore \".....\". Only transcribe actual alphanumeric text. "
     "Do NOT use HTML tags, XML, or any markup — plain text only. "
     "Do not describe the image, just return the extracted text. "
 )
@@ -150,11 +164,50 @@ PROMPT_BBOX_JSON = (
     "Return ONLY the JSON array, no explanation, no markdown fences."
 )
 
+# The format prompt goes in the system message so every page of a run shares a
+# byte-identical prefix (vLLM prefix cache); the per-page user turn is just this
+# short instruction followed by the image.
+USER_INSTRUCTION = "OCR this page."
+
+
+def system_message(output_format: str) -> dict:
+    prompt = {"json": PROMPT_BBOX_JSON, "html": PROMPT_HTML}.get(output_format, PROMPT_TEXT_ONLY)
+    return {"role": "system", "content": prompt}
+
 
 # ── API call ─────────────────────────────────────────────────
 
-def ocr_image_base64(
-    client: OpenAI,
+def make_http_client(transport_stats: dict | None = None) -> httpx.AsyncClient:
+    """HTTP client shared by all page requests.
+
+    With HTTP/2 (requires the h2 package, falls back to HTTP/1.1 without it)
+    every page is multiplexed over a single TLS connection to the RunPod proxy.
+    If `transport_stats` is given, the negotiated HTTP versions, the distinct
+    connections used and the number of requests sent (warmup and retries
+    included) are recorded in it, to check that multiplexing actually happens.
+    """
+    async def record_transport(response: httpx.Response) -> None:
+        transport_stats["versions"].add(response.http_version)
+        transport_stats["connections"].add(response.extensions.get("network_stream"))
+        transport_stats["requests"] += 1
+
+    hooks = {}
+    if transport_stats is not None:
+        transport_stats.setdefault("versions", set())
+        transport_stats.setdefault("connections", set())
+        transport_stats.setdefault("requests", 0)
+        hooks["response"] = [record_transport]
+
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=httpx.Timeout(connect=10.0, read=600.0, write=60.0, pool=10.0),
+        event_hooks=hooks,
+    )
+
+
+async def ocr_image_base64(
+    client: AsyncOpenAI,
     model: str,
     img_base64: str,
     mime_type: str,
@@ -163,17 +216,17 @@ def ocr_image_base64(
     max_tokens: int = 8192,
 ) -> str:
     """Send a single image to the OCR model and return the raw response text."""
-    prompt = {"json": PROMPT_BBOX_JSON, "html": PROMPT_HTML}.get(output_format, PROMPT_TEXT_ONLY)
 
     # Stream the response to keep the connection alive through Cloudflare's
     # 100s proxy timeout (HTTP 524 occurs with non-streaming long inference).
-    stream = client.chat.completions.create(
+    stream = await client.chat.completions.create(
         model=model,
         messages=[
+            system_message(output_format),
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": prompt},
+                    {"type": "text", "text": USER_INSTRUCTION},
                     {
                         "type": "image_url",
                         "image_url": {
@@ -188,73 +241,149 @@ def ocr_image_base64(
         extra_body={"repetition_penalty": repetition_penalty},
         stream=True,
     )
-    parts: list[str] = []
+    buf = io.StringIO()
     finish_reason: str | None = None
-    for chunk in stream:
+    async for chunk in stream:
         choice = chunk.choices[0] if chunk.choices else None
         if choice is None:
             continue
         if choice.delta.content:
-            parts.append(choice.delta.content)
+            buf.write(choice.delta.content)
         if choice.finish_reason:
             finish_reason = choice.finish_reason
     if finish_reason == "length":
         print(f"  ⚠️  finish_reason=length — réponse tronquée, augmenter max_tokens ({max_tokens})",
               file=sys.stderr)
-    return "".join(parts)
+    return buf.getvalue()
 
 
-# ── JSON post-processing ────────────────────────────────────
+async def warm_prefix_cache(client: AsyncOpenAI, model: str, output_format: str) -> None:
+    """Compute the shared prompt prefix once before the real pages go out.
 
-def parse_bbox_response(raw: str) -> list[dict]:
-    """Try to parse the model's bbox JSON response, tolerating markdown fences."""
-    text = raw.strip()
-    # Strip markdown code fences if present
-    if text.startswith("```"):
-        lines = text.split("\n")
-        # Remove first and last lines (fences)
-        lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines)
+    vLLM does not share an in-flight prefix computation between requests, so
+    N concurrent pages on a cold cache would each prefill the system prompt.
+    A 1-token request with a blank image fills the cache first.
+    """
+    from PIL import Image
+    buf = io.BytesIO()
+    # 32 px: Qwen-VL processors reject images smaller than one 28 px patch
+    Image.new("RGB", (32, 32), "white").save(buf, format="PNG")
+    blank = base64.b64encode(buf.getvalue()).decode("ascii")
     try:
-        data = json.loads(text)
-        if isinstance(data, list):
-            # Guard against [{"text": "<json array string>"}] wrapper
-            if (len(data) == 1 and isinstance(data[0], dict)
-                    and "text" in data[0] and "bbox" not in data[0]):
-                inner = data[0]["text"]
-                if isinstance(inner, str):
-                    try:
-                        parsed = json.loads(inner)
-                        if isinstance(parsed, list):
-                            return parsed
-                    except json.JSONDecodeError:
-                        pass
-            return data
-        # Model returned a bare dict — check if "text" field contains the actual array
-        if isinstance(data, dict) and "text" in data:
-            inner = data["text"]
-            if isinstance(inner, list):
-                return inner
+        await client.chat.completions.create(
+            model=model,
+            messages=[
+                system_message(output_format),
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": USER_INSTRUCTION},
+                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{blank}"}},
+                    ],
+                },
+            ],
+            temperature=0.0,
+            max_tokens=1,
+        )
+    except APIError as e:
+        print(f"  ⚠️  warmup échoué, on continue sans : {e}", file=sys.stderr)
+
+
+async def ocr_images(
+    client: AsyncOpenAI,
+    model: str,
+    images: list[tuple[Future, str]],
+    output_format: str,
+    backend: dict,
+    concurrency: int,
+    warmup: bool = False,
+) -> list[str]:
+    """OCR all images concurrently and return the raw responses in input order.
+
+    Each image is a future resolving to (base64_data, mime_type), so requests
+    go out as soon as their page is rendered while later pages still render.
+    All requests share the same system prompt, so vLLM schedules them in the
+    same batch and computes the prefix KV once instead of once per page.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def run_one(image: Future, label: str) -> str:
+        img_b64, mime = await asyncio.wrap_future(image)
+        async with sem:
+            raw = await ocr_image_base64(
+                client, model, img_b64, mime, output_format,
+                repetition_penalty=backend["repetition_penalty"],
+                max_tokens=backend["max_tokens"],
+            )
+        print(f"  {label} OK", file=sys.stderr)
+        return raw
+
+    try:
+        if warmup:
+            # Pages keep rendering in the process pool meanwhile
+            await warm_prefix_cache(client, model, output_format)
+        return await asyncio.gather(*(run_one(*img) for img in images))
+    finally:
+        await client.close()
+
+
+# ── JSON post-processing ────────────────────────────────────
+
+_JSON_ARRAY_RE = re.compile(r"\[.*\]", re.DOTALL)
+
+
+def _unwrap_regions(data) -> list:
+    """Normalize parsed JSON to a list of regions, undoing "text" wrappers."""
+    if isinstance(data, list):
+        # Guard against [{"text": "<json array string>"}] wrapper
+        if (len(data) == 1 and isinstance(data[0], dict)
+                and "text" in data[0] and "bbox" not in data[0]):
+            inner = data[0]["text"]
             if isinstance(inner, str):
                 try:
-                    parsed = json.loads(inner)
+                    parsed = _loads(inner)
                     if isinstance(parsed, list):
                         return parsed
                 except json.JSONDecodeError:
                     pass
-        return [data]
-    except json.JSONDecodeError:
-        # Last resort: try to extract a JSON array anywhere in the response
-        import re
-        m = re.search(r"\[.*\]", text, re.DOTALL)
-        if m:
+        return data
+    # Model returned a bare dict — check if "text" field contains the actual array
+    if isinstance(data, dict) and "text" in data:
+        inner = data["text"]
+        if isinstance(inner, list):
+            return inner
+        if isinstance(inner, str):
             try:
-                return json.loads(m.group())
+                parsed = _loads(inner)
+                if isinstance(parsed, list):
+                    return parsed
             except json.JSONDecodeError:
                 pass
-        return [{"text": raw, "bbox": None, "parse_error": True}]
+    return [data]
+
+
+def parse_bbox_response(raw: str) -> list[dict]:
+    """Try to parse the model's bbox JSON response, tolerating markdown fences."""
+    text = raw.strip()
+    # The prompt asks for a bare JSON array: try that first, fences only on failure
+    try:
+        return _unwrap_regions(_loads(text))
+    except json.JSONDecodeError:
+        pass
+    unfenced = strip_code_fences(text)
+    if unfenced is not text:
+        try:
+            return _unwrap_regions(_loads(unfenced))
+        except json.JSONDecodeError:
+            pass
+    # Last resort: try to extract a JSON array anywhere in the response
+    m = _JSON_ARRAY_RE.search(unfenced)
+    if m:
+        try:
+            return _loads(m.group())
+        except json.JSONDecodeError:
+            pass
+    return [{"text": raw, "bbox": None, "parse_error": True}]
 
 
 # ── Main ─────────────────────────────────────────────────────
@@ -282,6 +411,27 @@ def main():
         "--output", "-o", default=None,
         help="Fichier de sortie (défaut : stdout)",
     )
+    parser.add_argument(
+        "--concurrency", type=int, default=8,
+        help="Nombre maximal de requêtes simultanées vers vLLM (défaut : 8)",
+    )
+    parser.add_argument(
+        "--render-format", choices=list(RENDER_MIME), default="jpeg",
+        help="Format d'image des pages PDF rendues : jpeg (défaut) ou png",
+    )
+    parser.add_argument(
+        "--render-scale", type=float, default=1.5,
+        help="Facteur de rendu des pages PDF, 1.0 = 72 dpi (défaut : 1.5)",
+    )
+    parser.add_argument(
+        "--max-edge", type=int, default=1920,
+        help="Taille max (px) du plus grand côté des images, réduites avant envoi "
+             "(défaut : 1920, 0 = pas de réduction)",
+    )
+    parser.add_argument(
+        "--warmup", action="store_true",
+        help="Envoie d'abord une requête minimale pour remplir le cache de préfixe vLLM",
+    )
     args = parser.parse_args()
 
     input_path = Path(args.input)
@@ -290,23 +440,30 @@ def main():
         sys.exit(1)
 
     backend = BACKENDS[args.model]
-    pod_id = os.environ.get(backend["env_var"])
+    pod_id = resolve_pod_id(backend["env_var"], backend["pod_name"])
     if not pod_id:
         print(
-            f"Erreur : {backend['env_var']} manquant dans .env",
+            f"Erreur : {backend['env_var']} manquant dans .env "
+            f"et aucun pod {backend['pod_name']} actif",
             file=sys.stderr,
         )
         sys.exit(1)
 
     model_name = backend["model_name"]
     base_url = f"https://{pod_id}-8000.proxy.runpod.net/v1"
-    client = OpenAI(base_url=base_url, api_key="not-needed")
+    transport_stats: dict = {}
+    client = AsyncOpenAI(
+        base_url=base_url, api_key="not-needed",
+        http_client=make_http_client(transport_stats),
+    )
     print(f"Backend : {args.model} ({model_name})", file=sys.stderr)
+    print(f"Préfixe système : {prefix_hash(system_message(args.output_format))}", file=sys.stderr)
 
     is_pdf = input_path.suffix.lower() == ".pdf"
 
-    # Build list of (base64_data, mime_type, page_label) tuples
-    images: list[tuple[str, str, str]] = []
+    # Build list of (future of (base64_data, mime_type), page_label) tuples
+    images: list[tuple[Future, str]] = []
+    render_pool: ProcessPoolExecutor | None = None
 
     if is_pdf:
         total_pages = get_page_count(str(input_path))
@@ -319,27 +476,40 @@ def main():
             f"traitement de {len(page_nums)} page(s)",
             file=sys.stderr,
         )
+        # Render pages in parallel; OCR requests start as pages become ready
+        render_pool = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(page_nums) or 1))
         for pn in page_nums:
-            b64 = pdf_page_to_base64png(str(input_path), pn - 1)
-            images.append((b64, "image/png", f"page {pn}"))
+            future = render_pool.submit(
+                _render_page, str(input_path), pn - 1, args.render_format, args.render_scale,
+            )
+            images.append((future, f"page {pn}"))
     else:
-        b64, mime = image_to_base64(str(input_path))
-        images.append((b64, mime, input_path.name))
+        image: Future = Future()
+        image.set_result(image_to_base64(str(input_path), args.max_edge))
+        images.append((image, input_path.name))
         print(f"Image : {input_path.name}", file=sys.stderr)
 
-    # Process each image
+    # Process all images concurrently
+    try:
+        raws = asyncio.run(ocr_images(
+            client, model_name, images, args.output_format, backend,
+            max(1, args.concurrency), warmup=args.warmup,
+        ))
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown(cancel_futures=True)
+    if transport_stats["requests"]:
+        print(
+            f"Transport : {', '.join(sorted(transport_stats['versions']))}, "
+            f"{len(transport_stats['connections'])} connexion(s) pour "
+            f"{transport_stats['requests']} requête(s)",
+            file=sys.stderr,
+        )
+
     all_text_results: list[str] = []
     all_json_results: list[dict] = []
 
-    for img_b64, mime, label in images:
-        print(f"  {label}...", file=sys.stderr, end=" ", flush=True)
-        raw = ocr_image_base64(
-            client, model_name, img_b64, mime, args.output_format,
-            repetition_penalty=backend["repetition_penalty"],
-            max_tokens=backend["max_tokens"],
-        )
-        print("OK", file=sys.stderr)
-
+    for (_, label), raw in zip(images, raws):
         if args.output_format == "json":
             regions = parse_bbox_response(raw)
             for r in regions:
@@ -347,10 +517,7 @@ def main():
                     r["text"] = normalize_fill_zones(r["text"])
             all_json_results.append({"source": label, "regions": regions})
         elif args.output_format == "text":
-            # Safety net: strip HTML tags if the model returned markup anyway
-            cleaned = re.sub(r"<[^>]+>", " ", raw)
-            cleaned = re.sub(r" {2,}", " ", cleaned).strip()
-            all_text_results.append(normalize_fill_zones(cleaned))
+            all_text_results.append(clean_text_output(raw))
         else:  # html
             all_text_results.append(normalize_fill_zones(raw))
 
@@ -358,9 +525,9 @@ def main():
     if args.output_format == "json":
         # Flatten if single image
         if len(all_json_results) == 1:
-            output = json.dumps(all_json_results[0]["regions"], indent=2, ensure_ascii=False)
+            output = _dumps(all_json_results[0]["regions"])
         else:
-            output = json.dumps(all_json_results, indent=2, ensure_ascii=False)
+            output = _dumps(all_json_results)
     elif args.output_format == "html":
         body = "\n\n".join(all_text_results)
         output = f'<!DOCTYPE html>\n<html>\n<head><meta charset="UTF-8"></head>\n<body>\n{body}\n</body>\n</html>'
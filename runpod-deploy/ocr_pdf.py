@@ -2,64 +2,558 @@
 """OCR d'un fichier PDF via OLMoCR déployé sur RunPod."""
 
 import argparse
+import asyncio
+import base64
+import ctypes
+import hashlib
+import importlib.util
+import io
+import mmap
+import multiprocessing
 import os
+import re
+import shutil
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import TextIO
 
+import httpx
 import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
 from dotenv import load_dotenv
-from openai import OpenAI
-from olmocr.data.renderpdf import render_pdf_to_base64png
 from olmocr.prompts import build_no_anchoring_v4_yaml_prompt
+from PIL import ImageChops
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from tqdm import tqdm
 
+from runpod_util import CACHE_DIR, dumps_bytes, loads as _loads, parse_page_range, resolve_pod_id
 
-def get_page_count(pdf_path: str) -> int:
-    doc = pdfium.PdfDocument(pdf_path)
+try:
+    from blake3 import blake3 as _file_hasher
+except ImportError:
+    _file_hasher = hashlib.blake2b
+
+
+# Beyond this many characters of out-of-order page text held in memory,
+# further early pages are spilled to temporary files until their turn
+MAX_PENDING_CHARS = 16 << 20
+
+
+def map_pdf(pdf_path: str) -> ctypes.Array:
+    """Projette le PDF en mémoire, une seule fois pour tout le traitement.
+
+    Le tableau ctypes se passe tel quel à PdfDocument (chargé depuis la mémoire,
+    sans copie) et au hachage du cache. ACCESS_COPY car ctypes exige un buffer
+    inscriptible ; rien n'est jamais écrit, ni en mémoire ni dans le fichier.
+    """
+    with open(pdf_path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return (ctypes.c_char * len(data)).from_buffer(data)
+
+
+def get_page_count(pdf_data: str | ctypes.Array) -> int:
+    doc = pdfium.PdfDocument(pdf_data)
     count = len(doc)
     doc.close()
     return count
 
 
-def parse_page_range(spec: str, total: int) -> list[int]:
-    """Parse '3', '1-5', or '2,4,7-9' into a sorted list of 1-based page numbers."""
-    pages = set()
-    for part in spec.split(","):
-        part = part.strip()
-        if "-" in part:
-            start, end = part.split("-", 1)
-            start, end = int(start), int(end)
-            pages.update(range(start, min(end, total) + 1))
-        else:
-            p = int(part)
-            if 1 <= p <= total:
-                pages.add(p)
-    return sorted(pages)
+RENDER_MIME = {"jpeg": "image/jpeg", "png": "image/png"}
 
 
-def ocr_page(client: OpenAI, model: str, pdf_path: str, page_num: int) -> str:
-    """Extrait le texte d'une page PDF via OLMoCR."""
-    # page_num est 1-based, render_pdf_to_base64png attend 0-based
-    img_base64 = render_pdf_to_base64png(pdf_path, page_num - 1, target_longest_image_dim=1288)
-    prompt_text = build_no_anchoring_v4_yaml_prompt()
+def render_page(doc: pdfium.PdfDocument, page_idx: int, target_longest_image_dim: int = 1024,
+                image_format: str = "jpeg", jpeg_quality: int = 85) -> bytes:
+    """Rend une page (0-based) d'un document déjà ouvert en JPEG ou PNG (octets bruts).
+
+    Plus grand côté à `target_longest_image_dim` px, la même cible que
+    render_pdf_to_base64png d'olmocr ; le rendu se fait avec PDFium et non
+    pdftoppm (poppler), les pixels peuvent donc différer (lissage, polices).
+    Le JPEG est 3 à 6 fois plus léger qu'un PNG pour une page scannée ; le PNG
+    reste disponible pour un rendu sans perte.
+    """
+    page = doc[page_idx]
+    width, height = page.get_size()
+    bitmap = page.render(scale=target_longest_image_dim / max(width, height), rev_byteorder=True)
+    image = bitmap.to_pil()
+    # Most pages are black & white: one channel instead of three is about 3x
+    # fewer raw bytes to compress, and a smaller payload either way
+    r, g, b = image.split()
+    if ImageChops.difference(r, g).getbbox() is None and ImageChops.difference(g, b).getbbox() is None:
+        image = r
+    buf = io.BytesIO()
+    if image_format == "png":
+        # zlib level 1 encodes several times faster than the default 6 for a
+        # few percent more bytes, which is the better trade for rendered text
+        image.save(buf, format="PNG", compress_level=1)
+    else:
+        image.save(buf, format="JPEG", quality=jpeg_quality, optimize=True)
+    bitmap.close()
+    page.close()
+    return buf.getvalue()
+
+
+def embedded_text(doc: pdfium.PdfDocument, page_idx: int, min_words: int = 50) -> str | None:
+    """Texte intégré d'une page (0-based) purement textuelle, sinon None.
+
+    Une page avec plus de `min_words` mots extractibles et aucune image n'a
+    pas besoin du modèle : son texte est déjà exact dans le PDF. Il est rendu
+    brut, sans la mise en forme markdown que produirait le modèle.
+    """
+    page = doc[page_idx]
+    try:
+        if next(page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)), None) is not None:
+            return None
+        textpage = page.get_textpage()
+        text = textpage.get_text_range()
+        textpage.close()
+    finally:
+        page.close()
+    if len(text.split()) <= min_words:
+        return None
+    return text.replace("\r\n", "\n")
+
+
+# PDF projetés en mémoire par le processus principal (map_pdf), hérités par les
+# workers forkés ; vide sous spawn, où les workers rouvrent le fichier
+_shared_pdfs: dict[str, ctypes.Array] = {}
+
+# Documents ouverts par ce worker de rendu, gardés pour toute la vie du processus
+_worker_docs: dict[str, pdfium.PdfDocument] = {}
+
+
+def _render_page(pdf_path: str, page_idx: int, target_longest_image_dim: int,
+                 image_format: str, jpeg_quality: int, skip_text_pages: bool) -> bytes | str:
+    """Worker du pool de rendu : ouvre le PDF une seule fois par processus.
+
+    Renvoie l'image de la page, ou son texte intégré (str) si `skip_text_pages`
+    et que la page est purement textuelle.
+    """
+    doc = _worker_docs.get(pdf_path)
+    if doc is None:
+        doc = _worker_docs[pdf_path] = pdfium.PdfDocument(_shared_pdfs.get(pdf_path, pdf_path))
+    if skip_text_pages and (text := embedded_text(doc, page_idx)) is not None:
+        return text
+    return render_page(doc, page_idx, target_longest_image_dim, image_format, jpeg_quality)
+
+
+def encode_data_url(image_bytes: bytes, mime_type: str) -> str:
+    """Construit l'URL data: d'une image en une seule passe base64."""
+    # Concatenate as bytes, then a single ASCII decode (one memcpy) to the str
+    # the client needs, instead of formatting an intermediate base64 str
+    return (b"data:%b;base64," % mime_type.encode() + base64.b64encode(image_bytes)).decode("ascii")
+
+
+def log(message: str) -> None:
+    """Message sur stderr, affiché au-dessus de la barre de progression."""
+    tqdm.write(message, file=sys.stderr)
+
+
+def file_hash(data: ctypes.Array) -> str:
+    """Empreinte d'un contenu (blake3 si installé, sinon blake2b)."""
+    hasher = _file_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()[:32]
+
+
+def config_hash(*parts: object) -> str:
+    """Empreinte courte des réglages qui influent sur le texte produit."""
+    return hashlib.blake2b("\0".join(map(str, parts)).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def write_atomic(path: Path, text: str) -> None:
+    """Écrit `text` via un fichier temporaire, pour ne jamais laisser de fichier partiel."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def make_render_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Pool de processus pour le rendu PDFium, en fork sous Linux.
+
+    Le fork démarre les workers sans réimporter pypdfium2/PIL ni relire le
+    script (contrairement à spawn/forkserver, défaut à partir de Python 3.14),
+    et ils héritent en copy-on-write de la bibliothèque PDFium déjà chargée.
+
+    En fork, tous les workers sont créés tout de suite : à appeler tant que le
+    processus n'a qu'un thread (avant asyncio, tqdm, etc.), un fork depuis un
+    processus multi-thread pouvant bloquer les enfants sur un verrou hérité.
+    """
+    if sys.platform != "linux":
+        return ProcessPoolExecutor(max_workers=max_workers)
+    pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"))
+    # With fork, the first submit() forks every worker before starting the
+    # executor's manager thread
+    pool.submit(int)
+    return pool
+
+
+# HTTP/2 si le paquet h2 est installé, sinon repli en HTTP/1.1
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def make_http_client(base_url: str) -> httpx.AsyncClient:
+    """Client HTTP vers l'API vLLM d'un pod, partagé par toutes ses pages.
+
+    En HTTP/2 (paquet h2 requis, sinon repli en HTTP/1.1) toutes les requêtes
+    sont multiplexées sur une seule connexion TLS vers le proxy RunPod.
+    """
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=HTTP2,
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64, keepalive_expiry=60.0),
+    )
+
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
+async def prewarm(client: httpx.AsyncClient, connections: int) -> None:
+    """Ouvre d'avance des connexions vers le pod, hors du chemin de la 1re page.
+
+    Une requête légère (GET /models) par connexion paie la poignée de main
+    TCP + TLS avec le proxy RunPod ; la réponse, même en erreur, est ignorée.
+    En HTTP/2 toutes les requêtes partagent une seule connexion : une seule
+    requête suffit alors.
+    """
+    await asyncio.gather(*(client.get("models") for _ in range(connections)), return_exceptions=True)
+
+
+# Séparateur demandé au modèle entre les pages d'une requête multi-images.
+# Pas "---" : OLMoCR l'utilise déjà pour son front matter YAML.
+PAGE_BREAK = "=====PAGE BREAK====="
+_PAGE_BREAK_RE = re.compile(rf"\n?^{PAGE_BREAK}$\n?", re.MULTILINE)
+
+
+def batch_prompt(prompt_text: str, n_pages: int) -> str:
+    """Adapte le prompt OLMoCR à une requête contenant `n_pages` images."""
+    return (
+        f"Attached are {n_pages} pages of a document, one image per page, in order. "
+        f"Process each page separately as instructed below, and output the results in the "
+        f"same order, separated by a line containing only {PAGE_BREAK}.\n\n{prompt_text}"
+    )
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Erreur qui peut passer en réessayant : réseau, 429 ou 5xx.
+
+    Une autre réponse 4xx vient de la requête elle-même (par exemple un lot
+    multi-images qui dépasse --max-model-len) : la renvoyer ne changerait rien.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+async def ocr_request(client: httpx.AsyncClient, model: str, prompt_text: str, max_tokens: int,
+                      image_urls: list[str], label: str) -> str:
+    """Envoie une requête OLMoCR (une ou plusieurs images) et renvoie le texte généré.
+
+    Les erreurs transitoires (le proxy RunPod coupe parfois les connexions,
+    voir is_transient) sont retentées jusqu'à 5 fois avec un backoff
+    exponentiel ; la dernière, ou toute autre erreur HTTP, est levée. Un flux
+    illisible ou une erreur signalée en cours de flux compte comme une
+    coupure : httpx.RemoteProtocolError, retentée puis levée comme les autres.
+    """
+    # Serialized once with orjson and POSTed as-is: the SDK would re-encode the
+    # multi-hundred-KB base64 images with the stdlib json module on every try
+    body = dumps_bytes({
+        "model": model,
+        "messages": [
             {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt_text},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{img_base64}"},
-                    },
+                    *({"type": "image_url", "image_url": {"url": url}} for url in image_urls),
                 ],
             }
         ],
-        temperature=0.0,
-        max_tokens=4096,
+        "temperature": 0.0,
+        "max_tokens": max_tokens,
+        # Streamed: no single long-held response for the RunPod proxy to time out
+        "stream": True,
+    })
+    # The whole stream is inside the retry: a connection can also drop mid-response
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(5),
+        wait=wait_exponential_jitter(initial=1, max=30),
+        retry=retry_if_exception(is_transient),
+        reraise=True,
+    ):
+        with attempt:
+            buf = io.StringIO()
+            finish_reason: str | None = None
+            async with client.stream(
+                "POST", "chat/completions", content=body, headers={"Content-Type": "application/json"},
+            ) as response:
+                response.raise_for_status()
+                # Server-sent events: one "data: {json chunk}" line per delta
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    if (data := line[6:]) == "[DONE]":
+                        break
+                    try:
+                        chunk = _loads(data)
+                    except ValueError as e:
+                        raise httpx.RemoteProtocolError(f"invalid SSE chunk: {e}") from e
+                    if "error" in chunk or chunk.get("object") == "error":
+                        raise httpx.RemoteProtocolError(f"error in stream: {chunk.get('error', chunk)}")
+                    choices = chunk.get("choices")
+                    if not choices:
+                        continue
+                    if content := choices[0].get("delta", {}).get("content"):
+                        buf.write(content)
+                    if choices[0].get("finish_reason"):
+                        finish_reason = choices[0]["finish_reason"]
+    if finish_reason == "length":
+        log(f"  ⚠️  {label} : réponse tronquée, augmenter --max-tokens ({max_tokens})")
+    return buf.getvalue()
+
+
+# Un pod en échec passe après les autres pendant ce nombre de secondes
+POD_COOLDOWN = 60.0
+
+# Échéance (horloge de la boucle asyncio) du cooldown de chaque pod en échec
+_pod_down_until: dict[httpx.AsyncClient, float] = {}
+
+
+async def ocr_request_any(pods: dict[httpx.AsyncClient, int], model: str, prompt_text: str,
+                          max_tokens: int, image_urls: list[str], label: str) -> str:
+    """ocr_request() sur le pod qui a le moins de requêtes en cours.
+
+    `pods` associe chaque client à son nombre de requêtes en cours. Si un pod
+    échoue de façon transitoire après toutes ses tentatives, la requête repart
+    sur un autre pod, et celui-ci passe après les autres pendant POD_COOLDOWN
+    secondes ; l'erreur n'est levée que lorsque tous ont échoué. Une erreur
+    propre à la requête (4xx) est levée directement.
+    """
+    loop = asyncio.get_running_loop()
+    failed: set[httpx.AsyncClient] = set()
+    while True:
+        now = loop.time()
+        client = min(
+            (c for c in pods if c not in failed),
+            key=lambda c: (_pod_down_until.get(c, 0.0) > now, pods[c]),
+        )
+        pods[client] += 1
+        try:
+            return await ocr_request(client, model, prompt_text, max_tokens, image_urls, label)
+        except httpx.HTTPError as e:
+            if not is_transient(e):
+                raise
+            failed.add(client)
+            _pod_down_until[client] = loop.time() + POD_COOLDOWN
+            if len(failed) == len(pods):
+                raise
+            log(f"  ⚠️  {label} : échec sur {client.base_url.host} ({e}), bascule sur un autre pod")
+        finally:
+            pods[client] -= 1
+
+
+async def ocr_page(pods: dict[httpx.AsyncClient, int], model: str, prompt_text: str, max_tokens: int,
+                   page_num: int, image_url: str) -> tuple[int, str]:
+    """Extrait le texte d'une page PDF déjà rendue via OLMoCR, renvoie (page_num, texte).
+
+    Une page en échec après toutes les tentatives donne un texte vide, pour que
+    le reste du document soit quand même produit.
+    """
+    try:
+        text = await ocr_request_any(pods, model, prompt_text, max_tokens, [image_url], f"Page {page_num}")
+    except httpx.HTTPError as e:
+        log(f"  ❌ Page {page_num} : échec définitif, page laissée vide ({e})")
+        text = ""
+    return page_num, text
+
+
+async def ocr_batch(pods: dict[httpx.AsyncClient, int], model: str, prompt_text: str, max_tokens: int,
+                    batch: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    """OCR de plusieurs pages rendues en une seule requête multi-images.
+
+    La réponse est redécoupée sur PAGE_BREAK ; si le nombre de morceaux ne
+    correspond pas au nombre de pages, ou si la requête échoue, chaque page est
+    renvoyée seule.
+    """
+    if len(batch) == 1:
+        return [await ocr_page(pods, model, prompt_text, max_tokens, *batch[0])]
+
+    page_nums = [page_num for page_num, _ in batch]
+    label = "Pages " + ",".join(map(str, page_nums))
+    try:
+        text = await ocr_request_any(
+            pods, model, batch_prompt(prompt_text, len(batch)), max_tokens * len(batch),
+            [image_url for _, image_url in batch], label,
+        )
+    except httpx.HTTPError as e:
+        log(f"  ⚠️  {label} : échec de la requête groupée ({e}), nouvel essai page par page")
+    else:
+        parts = _PAGE_BREAK_RE.split(text)
+        if len(parts) == len(batch):
+            return list(zip(page_nums, parts))
+        log(f"  ⚠️  {label} : {len(parts)} page(s) dans la réponse au lieu de {len(batch)}, "
+            f"nouvel essai page par page")
+    return await asyncio.gather(
+        *(ocr_page(pods, model, prompt_text, max_tokens, *item) for item in batch)
     )
-    return response.choices[0].message.content
+
+
+async def ocr_pages(clients: list[httpx.AsyncClient], model: str, pdf_path: str,
+                    pdf_data: ctypes.Array, render_pool: ProcessPoolExecutor, render_workers: int,
+                    pages: list[int], concurrency: int,
+                    image_dim: int = 1024, image_format: str = "jpeg",
+                    jpeg_quality: int = 85, max_tokens: int = 1536,
+                    pages_per_request: int = 1, out: TextIO = sys.stdout,
+                    cache_dir: Path | None = CACHE_DIR, skip_text_pages: bool = False) -> None:
+    """OCR de toutes les pages, en pipeline rendu → envoi → collecte.
+
+    Les pages sont rendues en parallèle par les `render_workers` processus de
+    `render_pool` (PDFium n'est pas thread-safe) et placées dans une file bornée ; `concurrency`
+    consommateurs par pod envoient les requêtes pendant que les pages suivantes
+    se rendent, chacune regroupant jusqu'à `pages_per_request` pages déjà
+    prêtes. Chaque requête part vers le pod le moins chargé de `clients`.
+
+    Le texte est écrit dans `out` au fil de l'eau, dans l'ordre des pages :
+    seules les pages arrivées avant leurs prédécesseurs restent en mémoire.
+
+    Avec `cache_dir`, le texte de chaque page est mis en cache sur disque, par
+    contenu du PDF, modèle, prompt et réglages de rendu : une page déjà traitée
+    n'est ni rendue ni renvoyée au modèle.
+
+    Avec `skip_text_pages`, les pages purement textuelles sont reprises telles
+    quelles du texte intégré au PDF, sans passer par le modèle.
+    """
+    loop = asyncio.get_running_loop()
+    pods = dict.fromkeys(clients, 0)
+    warm_connections = 1 if HTTP2 else min(concurrency, 16)
+    concurrency *= len(clients)
+    mime_type = RENDER_MIME[image_format]
+    # Same prompt for every page: build it once
+    prompt_text = build_no_anchoring_v4_yaml_prompt()
+    # Text split out of a multi-page response may differ from single-page
+    # output, so the batch size is part of the cache key too
+    settings = config_hash(model, prompt_text, max_tokens, image_dim, image_format, jpeg_quality,
+                           pages_per_request)
+    # Backpressure: at most render_workers renders in flight, plus the queue
+    render_sem = asyncio.Semaphore(render_workers)
+    queue: asyncio.Queue[tuple[int, str] | None] = asyncio.Queue(maxsize=2 * concurrency * pages_per_request)
+    # Out-of-order results wait here until every earlier page is written,
+    # in memory up to MAX_PENDING_CHARS, then as files in spill_dir
+    pending: dict[int, str | Path] = {}
+    pending_chars = 0
+    spill_dir: tempfile.TemporaryDirectory | None = None
+    next_to_write = 0
+
+    def write_in_order(page_num: int, text: str) -> None:
+        nonlocal next_to_write, pending_chars, spill_dir
+        if page_num != pages[next_to_write] and pending_chars + len(text) > MAX_PENDING_CHARS:
+            if spill_dir is None:
+                spill_dir = tempfile.TemporaryDirectory(prefix="ocr_pdf_")
+            part = Path(spill_dir.name) / f"p{page_num}.txt"
+            part.write_text(text, encoding="utf-8")
+            pending[page_num] = part
+        else:
+            pending[page_num] = text
+            pending_chars += len(text)
+        while next_to_write < len(pages) and pages[next_to_write] in pending:
+            if next_to_write:
+                out.write("\n\n")
+            item = pending.pop(pages[next_to_write])
+            if isinstance(item, Path):
+                with open(item, encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+                item.unlink()
+            else:
+                out.write(item)
+                pending_chars -= len(item)
+            next_to_write += 1
+
+    async def render(render_pool: ProcessPoolExecutor, page_num: int) -> None:
+        async with render_sem:
+            # page_num est 1-based, _render_page attend 0-based
+            # Workers send back raw bytes (a third smaller to pickle than
+            # base64); encoding runs in a thread, overlapping in-flight requests
+            image_bytes = await loop.run_in_executor(
+                render_pool, _render_page, pdf_path, page_num - 1,
+                image_dim, image_format, jpeg_quality, skip_text_pages,
+            )
+            if isinstance(image_bytes, str):
+                # Embedded text of a text-only page: nothing to send to the model
+                write_in_order(page_num, image_bytes)
+                progress.update()
+                return
+            image_url = await loop.run_in_executor(None, encode_data_url, image_bytes, mime_type)
+            await queue.put((page_num, image_url))
+
+    def cache_path(page_num: int) -> Path:
+        return cache_dir / f"p{page_num}_{settings}.txt"
+
+    async def produce(render_pool: ProcessPoolExecutor) -> None:
+        to_render = []
+        for page_num in pages:
+            try:
+                text = cache_path(page_num).read_text(encoding="utf-8") if cache_dir else None
+            except FileNotFoundError:
+                text = None
+            except (OSError, UnicodeDecodeError) as e:
+                # The cache is best-effort: an unreadable entry is OCR'd again
+                log(f"  ⚠️  Page {page_num} : cache illisible, page retraitée ({e})")
+                text = None
+            if text is None:
+                to_render.append(page_num)
+            else:
+                write_in_order(page_num, text)
+                progress.update()
+        await asyncio.gather(*(render(render_pool, page_num) for page_num in to_render))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consume() -> None:
+        done = False
+        while not done and (item := await queue.get()) is not None:
+            # Top the batch up with pages already rendered, without waiting
+            batch = [item]
+            while len(batch) < pages_per_request and not queue.empty():
+                if (item := queue.get_nowait()) is None:
+                    done = True
+                    break
+                batch.append(item)
+            batch.sort()
+            for page_num, text in await ocr_batch(pods, model, prompt_text, max_tokens, batch):
+                # Empty text means the page failed: leave it out of the cache
+                if cache_dir and text:
+                    try:
+                        write_atomic(cache_path(page_num), text)
+                    except OSError as e:
+                        log(f"  ⚠️  Page {page_num} : écriture du cache impossible ({e})")
+                write_in_order(page_num, text)
+                progress.update()
+
+    warmup: asyncio.Future | None = None
+    progress = tqdm(total=len(pages), desc="OCR", unit="page", file=sys.stderr)
+    try:
+        # Handshakes run while the PDF is hashed and the first pages render
+        warmup = asyncio.gather(*(prewarm(client, warm_connections) for client in clients))
+        if cache_dir is not None:
+            cache_dir = cache_dir / await asyncio.to_thread(file_hash, pdf_data)
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                log(f"  ⚠️  Cache indisponible, on continue sans ({e})")
+                cache_dir = None
+        await asyncio.gather(warmup, produce(render_pool), *(consume() for _ in range(concurrency)))
+    finally:
+        if warmup is not None:
+            # No-op once done; otherwise setup failed and the handshakes are moot
+            warmup.cancel()
+            await asyncio.gather(warmup, return_exceptions=True)
+        progress.close()
+        if spill_dir is not None:
+            spill_dir.cleanup()
+        await asyncio.gather(*(client.aclose() for client in clients))
 
 
 def main():
@@ -67,10 +561,27 @@ def main():
 
     parser = argparse.ArgumentParser(description="OCR d'un PDF via OLMoCR sur RunPod")
     parser.add_argument("pdf", help="Chemin vers le fichier PDF")
-    parser.add_argument("--pod-id", default=None, help="ID du pod RunPod (défaut : OLMOCR_POD_ID du .env)")
+    parser.add_argument("--pod-id", default=None,
+                        help="ID du pod RunPod, ou plusieurs séparés par des virgules pour répartir "
+                             "les pages (défaut : OLMOCR_POD_ID du .env)")
     parser.add_argument("--pages", default=None, help="Pages à traiter : 3, 1-5, 2,4,7-9 (défaut : toutes)")
     parser.add_argument("--output", "-o", default=None, help="Fichier de sortie (défaut : stdout)")
     parser.add_argument("--model", default="olmocr", help="Nom du modèle vLLM (défaut : olmocr)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"Ne pas lire ni écrire le cache des pages déjà traitées ({CACHE_DIR})")
+    parser.add_argument("--skip-text-pages", action="store_true",
+                        help="Reprendre tel quel le texte intégré des pages sans image (> 50 mots), "
+                             "sans appeler le modèle ; ce texte est brut, sans la mise en forme "
+                             "markdown des pages passées au modèle")
+    parser.add_argument("--max-tokens", type=int, default=1536,
+                        help="Nombre max de tokens générés par page (défaut : 1536)")
+    parser.add_argument("--pages-per-request", type=int, default=1,
+                        help="Pages envoyées par requête multi-images, max 4 avec startup_olmocr.sh (défaut : 1)")
+    parser.add_argument("--image-dim", type=int, default=1024,
+                        help="Plus grand côté (px) des pages rendues, max 1288 pour OLMoCR (défaut : 1024)")
+    parser.add_argument("--image-format", choices=list(RENDER_MIME), default="jpeg",
+                        help="Format des pages rendues envoyées au modèle : jpeg (défaut) ou png")
+    parser.add_argument("--jpeg-quality", type=int, default=85, help="Qualité JPEG des pages rendues (défaut : 85)")
     args = parser.parse_args()
 
     pdf_path = Path(args.pdf)
@@ -78,36 +589,51 @@ def main():
         print(f"Erreur : fichier introuvable : {pdf_path}", file=sys.stderr)
         sys.exit(1)
 
-    pod_id = args.pod_id or os.environ.get("OLMOCR_POD_ID")
-    if not pod_id:
-        print("Erreur : --pod-id requis ou OLMOCR_POD_ID dans .env", file=sys.stderr)
+    pod_ids = args.pod_id or resolve_pod_id("OLMOCR_POD_ID", "fuzzion-olmocr")
+    if not pod_ids:
+        print("Erreur : --pod-id requis, OLMOCR_POD_ID dans .env ou pod fuzzion-olmocr actif",
+              file=sys.stderr)
         sys.exit(1)
 
-    base_url = f"https://{pod_id}-8000.proxy.runpod.net/v1"
-    client = OpenAI(base_url=base_url, api_key="not-needed")
+    # One client, and so one connection pool, per pod
+    clients = [
+        make_http_client(f"https://{pod_id}-8000.proxy.runpod.net/v1")
+        for pod_id in dict.fromkeys(p.strip() for p in pod_ids.split(",") if p.strip())
+    ]
 
-    total_pages = get_page_count(str(pdf_path))
+    pdf_data = map_pdf(str(pdf_path))
+    total_pages = get_page_count(pdf_data)
     if args.pages:
         pages = parse_page_range(args.pages, total_pages)
     else:
         pages = list(range(1, total_pages + 1))
 
-    print(f"PDF : {pdf_path.name} — {total_pages} page(s), traitement de {len(pages)} page(s)", file=sys.stderr)
-
-    results = []
-    for page_num in pages:
-        print(f"  Page {page_num}/{total_pages}...", file=sys.stderr, end=" ", flush=True)
-        text = ocr_page(client, args.model, str(pdf_path), page_num)
-        results.append(text)
-        print("OK", file=sys.stderr)
+    print(f"PDF : {pdf_path.name} — {total_pages} page(s), traitement de {len(pages)} page(s)"
+          f" sur {len(clients)} pod(s)", file=sys.stderr)
 
-    output_text = "\n\n".join(results)
+    concurrency = max(1, int(os.environ.get("OCR_CONCURRENCY", "16")))
+    render_workers = min(os.cpu_count() or 1, len(pages)) or 1
+    # Forked render workers inherit the mapping and load the PDF straight from it
+    _shared_pdfs[str(pdf_path)] = pdf_data
+    # Created before asyncio.run(): the workers are forked while no thread exists yet
+    with make_render_pool(render_workers) as render_pool:
+        # Pages are written as they complete; a large buffer keeps that to few syscalls
+        out = open(args.output, "w", encoding="utf-8", buffering=1 << 20) if args.output else sys.stdout
+        try:
+            asyncio.run(ocr_pages(
+                clients, args.model, str(pdf_path), pdf_data, render_pool, render_workers, pages, concurrency,
+                image_dim=args.image_dim, image_format=args.image_format, jpeg_quality=args.jpeg_quality,
+                max_tokens=args.max_tokens, pages_per_request=args.pages_per_request, out=out,
+                cache_dir=None if args.no_cache else CACHE_DIR, skip_text_pages=args.skip_text_pages,
+            ))
+        finally:
+            if args.output:
+                out.close()
 
     if args.output:
-        Path(args.output).write_text(output_text, encoding="utf-8")
         print(f"Résultat écrit dans {args.output}", file=sys.stderr)
     else:
-        print(output_text)
+        print()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+"""Code partagé par les scripts Python (ask.py, ocr.py, ocr_pdf.py).
+
+Accès à l'API REST RunPod (comme les scripts shell, on passe par
+rest.runpod.io/v1 et non par le SDK Python), JSON, plages de pages, encodage
+des images et nettoyage des réponses du modèle.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+# orjson (optional) parses and serializes large JSON payloads several times faster
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        """Indented JSON, non-ASCII kept as-is."""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def dumps_bytes(obj) -> bytes:
+        """Compact UTF-8 JSON, ready to send as a request body."""
+        return orjson.dumps(obj)
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj) -> str:
+        """Indented JSON, non-ASCII kept as-is."""
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+
+    def dumps_bytes(obj) -> bytes:
+        """Compact UTF-8 JSON, ready to send as a request body."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+PODS_URL = "https://rest.runpod.io/v1/pods"
+
+# Per-user cache directory, like the OCR page cache of ocr_pdf.py
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "experimental_ocr"
+
+# Only what resolve_pod_id() needs: the full pod objects also carry each pod's
+# env (HF_TOKEN, STARTUP_B64, ...), which must never be written to disk
+_CACHED_POD_FIELDS = ("id", "name", "desiredStatus")
+
+
+def cached_get_pods(api_key: str, ttl: float = 60.0) -> list[dict]:
+    """Return the RunPod pod list (id, name, desiredStatus only), cached for `ttl` seconds.
+
+    The cache file lives in the user's cache directory and is keyed by a hash
+    of the API key, so successive CLI calls within the TTL don't hit the RunPod
+    control plane again.
+    """
+    digest = hashlib.sha1(api_key.encode()).hexdigest()[:8]
+    cache = CACHE_DIR / f"runpod_pods_{digest}.json"
+    try:
+        if time.time() - cache.stat().st_mtime < ttl:
+            return json.loads(cache.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        pass
+
+    response = httpx.get(PODS_URL, headers={"Authorization": f"Bearer {api_key}"}, timeout=15.0)
+    response.raise_for_status()
+    pods = [{k: pod.get(k) for k in _CACHED_POD_FIELDS} for pod in response.json()]
+
+    # Write atomically so a concurrent invocation never reads a partial file;
+    # mkstemp creates the temp file exclusively, readable by this user only.
+    # The cache is only an optimisation: an unwritable directory is ignored.
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=f"{cache.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(pods, f)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
+    return pods
+
+
+def resolve_pod_id(env_var: str, pod_name: str) -> str | None:
+    """Pod ID from `env_var`, or else the running pod named `pod_name`.
+
+    The fallback needs RUNPOD_API_KEY; returns None if no pod can be found.
+    """
+    pod_id = os.environ.get(env_var)
+    if pod_id:
+        return pod_id
+
+    api_key = os.environ.get("RUNPOD_API_KEY")
+    if not api_key:
+        return None
+    try:
+        pods = cached_get_pods(api_key)
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Avertissement : liste des pods RunPod indisponible ({e})", file=sys.stderr)
+        return None
+    for pod in pods:
+        if pod.get("name") == pod_name and pod.get("desiredStatus") == "RUNNING":
+            return pod.get("id")
+    return None
+
+
+# ── Page ranges ──────────────────────────────────────────────
+
+_PAGE_RANGE_RE = re.compile(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?")
+
+
+def parse_page_range(spec: str, total: int) -> list[int]:
+    """Parse '3', '1-5', or '2,4,7-9' into a sorted list of 1-based page numbers.
+
+    Pages outside 1..total are dropped; a malformed part raises ValueError.
+    """
+    # One flag byte per page: ranges are set with a single slice assignment
+    # and the result comes out sorted and deduplicated by scanning once
+    seen = bytearray(total + 1)
+    for part in spec.split(","):
+        match = _PAGE_RANGE_RE.fullmatch(part)
+        if match is None:
+            raise ValueError(f"invalid page range: {part!r}")
+        start = max(int(match[1]), 1)
+        end = min(int(match[2] or match[1]), total)
+        if start <= end:
+            seen[start:end + 1] = b"\x01" * (end - start + 1)
+    return [p for p in range(1, total + 1) if seen[p]]
+
+
+# ── Images ───────────────────────────────────────────────────
+
+IMAGE_MIME = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+    ".bmp": "image/bmp",
+    ".tiff": "image/tiff",
+    ".tif": "image/tiff",
+}
+
+
+def image_to_base64(image_path: str, max_edge: int = 1920) -> tuple[str, str]:
+    """Read an image file and return (base64_data, mime_type).
+
+    Images whose longest side exceeds `max_edge` pixels are downscaled and
+    re-encoded as JPEG; smaller images are sent as-is (0 disables resizing).
+    """
+    path = Path(image_path)
+    if max_edge > 0:
+        from PIL import Image, ImageOps, UnidentifiedImageError
+        try:
+            im = Image.open(path)
+        except UnidentifiedImageError:
+            # Empty or not decodable by PIL: sent as-is, as before resizing existed
+            im = None
+        if im is not None:
+            with im:
+                if max(im.size) > max_edge:
+                    # Vision tokens grow with pixel count: downscale before upload
+                    im = ImageOps.exif_transpose(im)
+                    im.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+                    buf = io.BytesIO()
+                    im.convert("RGB").save(buf, format="JPEG", quality=88, optimize=True)
+                    return base64.b64encode(buf.getvalue()).decode("ascii"), "image/jpeg"
+    mime = IMAGE_MIME.get(path.suffix.lower(), "image/jpeg")
+    if path.stat().st_size == 0:
+        # mmap cannot map an empty file
+        return "", mime
+    # Encode straight from a read-only mapping: no intermediate bytes copy
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = base64.b64encode(mm).decode("ascii")
+    return data, mime
+
+
+# ── Prompts and responses ────────────────────────────────────
+
+def prefix_hash(message: dict) -> str:
+    """Short hash of the message every request starts with.
+
+    Compare it across runs, together with vLLM's "Prefix cache hit rate" log
+    line, to spot prompt drift that silently defeats the prefix cache.
+    """
+    canonical = json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(canonical, digest_size=8).hexdigest()
+
+
+def strip_code_fences(text: str) -> str:
+    """Remove a surrounding ```lang ... ``` markdown fence, if present.
+
+    Slices once around the opening line and the last fence instead of
+    splitting the whole response into lines.
+    """
+    if not text.startswith("```"):
+        return text
+    nl = text.find("\n")
+    if nl < 0:
+        return text
+    end = text.rfind("```")
+    return text[nl + 1:end] if end > nl else text[nl + 1:]
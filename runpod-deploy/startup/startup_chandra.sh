@@ -10,8 +10,11 @@ MODEL_ID="datalab-to/chandra"
 MODEL_DIR="/workspace/models/chandra"
 LOG_DIR="/workspace/logs"
 HF_CACHE="/workspace/hf_cache"
+# Seul dossier lisible via des URL file:// : l'API vLLM est publique et sans
+# authentification, tout le reste du volume (modèles, cache HF, logs) reste fermé
+SCANS_DIR="/workspace/scans"
 
-mkdir -p "$LOG_DIR" "$HF_CACHE" "$(dirname $MODEL_DIR)"
+mkdir -p "$LOG_DIR" "$HF_CACHE" "$SCANS_DIR" "$(dirname $MODEL_DIR)"
 export HF_HOME="$HF_CACHE"
 
 echo "[$(date)] =========================================="
@@ -50,6 +53,8 @@ vllm serve "$MODEL_DIR" \
     --max-num-seqs 32 \
     --max-num-batched-tokens 65536 \
     --enable-prefix-caching \
+    --enable-chunked-prefill \
+    --allowed-local-media-path "$SCANS_DIR" \
     --trust-remote-code \
     > "$LOG_DIR/vllm_chandra.log" 2>&1 &
 
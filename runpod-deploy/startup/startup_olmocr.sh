@@ -43,8 +43,9 @@ vllm serve "$MODEL_DIR" \
     --port 8000 \
     --dtype bfloat16 \
     --gpu-memory-utilization 0.88 \
-    --max-model-len 8192 \
-    --limit-mm-per-prompt '{"image": 1}' \
+    --max-model-len 16384 \
+    --limit-mm-per-prompt '{"image": 4}' \
+    --enable-prefix-caching \
     --trust-remote-code \
     > "$LOG_DIR/vllm_olmocr.log" 2>&1 &
 
@@ -10,8 +10,11 @@ MODEL_ID="Qwen/Qwen3-VL-8B-Instruct"
 MODEL_DIR="/workspace/models/qwen3-vl-8b"
 LOG_DIR="/workspace/logs"
 HF_CACHE="/workspace/hf_cache"
+# Seul dossier lisible via des URL file:// : l'API vLLM est publique et sans
+# authentification, tout le reste du volume (modèles, cache HF, logs) reste fermé
+SCANS_DIR="/workspace/scans"
 
-mkdir -p "$LOG_DIR" "$HF_CACHE" "$(dirname $MODEL_DIR)"
+mkdir -p "$LOG_DIR" "$HF_CACHE" "$SCANS_DIR" "$(dirname $MODEL_DIR)"
 export HF_HOME="$HF_CACHE"
 
 echo "[$(date)] =========================================="
@@ -47,6 +50,8 @@ vllm serve "$MODEL_DIR" \
     --max-model-len 14080 \
     --limit-mm-per-prompt '{"image": 5}' \
     --enable-prefix-caching \
+    --enable-chunked-prefill \
+    --allowed-local-media-path "$SCANS_DIR" \
     --trust-remote-code \
     > "$LOG_DIR/vllm_qwen3vl.log" 2>&1 &
 